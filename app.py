@@ -86,11 +86,29 @@ VERSION: 1.0.0
 import os
 import json
 import asyncio
-from typing import Optional, List, Dict, Tuple
+import heapq
+import logging
+from typing import Callable, Optional, List, Dict, Tuple
+from functools import lru_cache
 import warnings
 
+# Shared helpers; importing mcp_common also installs the uvloop policy when USE_UVLOOP=1
+from mcp_common import (
+    HTTP2_ENABLED,
+    OPENAI_HTTPX,
+    format_raw_tool_arguments,
+    get_logger,
+    json_dumps_pretty,
+    json_loads,
+    openai_tool,
+    parse_tool_arguments,
+    stream_chat_completion,
+    trim_messages,
+    truncate_tool_output,
+)
+
 import chainlit as cl
-from openai import OpenAI
+from openai import AsyncOpenAI
 import httpx
 
 # Suppress httpcore async generator warnings from SSE streaming
@@ -101,36 +119,57 @@ warnings.filterwarnings('ignore', category=RuntimeWarning)
 # ============================================================================
 
 # OpenAI Configuration
-client = OpenAI()  # Reads OPENAI_API_KEY from environment
+client = AsyncOpenAI(http_client=OPENAI_HTTPX)  # Reads OPENAI_API_KEY from environment
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+# Log records are written by a background thread (see mcp_common.get_logger)
+log = get_logger("app")
+
 # MCP Server Configuration
 MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "http://localhost:8000/mcp")
 
+# Shared HTTP connection pool for all MCP traffic (reused across chat sessions)
+HTTPX = httpx.AsyncClient(
+    http2=HTTP2_ENABLED,
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=100),
+    timeout=httpx.Timeout(60.0, connect=5.0),  # Unreachable servers fail fast in the transport
+)
+
 # Global State
-mcp_session: Optional['MCPClient'] = None
+mcp_session: Optional['MCPClient'] = None  # shared by all chats, see get_mcp_session()
 all_tools: List[Dict] = []
+openai_tools_all: List[Dict] = []  # all_tools converted to OpenAI format, same order
+tool_index: List[Dict] = []  # build_tool_index(all_tools), same order
+default_indices: List[int] = []  # default_tool_indices(tool_index)
 
 
 # ============================================================================
 # MCP Protocol Implementation
 # ============================================================================
 
-def parse_sse_response(text: str) -> Optional[dict]:
-    """Parse Server-Sent Events (SSE) formatted response from MCP server."""
-    lines = text.strip().split('\n')
+def parse_sse_response(frame: bytes) -> Optional[dict]:
+    """
+    Parse the `data:` field of one Server-Sent Events (SSE) frame from the MCP server.
     
-    for line in lines:
-        line = line.strip()
-        if line.startswith('data: '):
-            data_json = line[6:]
-            try:
-                return json.loads(data_json)
-            except json.JSONDecodeError as e:
-                print(f"[ERROR] Failed to parse JSON: {e}")
-                return None
+    Scans directly for the field instead of splitting the frame into lines;
+    only the first `data:` line is used, as MCP sends one JSON message per event.
+    """
+    if frame.startswith(b'data:'):
+        start = len(b'data:')
+    else:
+        start = frame.find(b'\ndata:')
+        if start < 0:
+            return None
+        start += len(b'\ndata:')
+    
+    end = frame.find(b'\n', start)
+    data_json = frame[start:end if end >= 0 else len(frame)].strip()
     
-    return None
+    try:
+        return json_loads(data_json)
+    except json.JSONDecodeError as e:
+        log.error("Failed to parse JSON: %s", e)
+        return None
 
 
 class MCPClient:
@@ -139,7 +178,8 @@ class MCPClient:
     def __init__(self, url: str):
         self.url = url
         self.request_id = 0
-        self.client = httpx.AsyncClient(timeout=30.0)
+        self.client = HTTPX
+        self._tools_prefetch: Optional[asyncio.Task] = None
         
     async def send_request(self, method: str, params: Optional[dict] = None) -> dict:
         """Send JSON-RPC request to MCP server and parse SSE response."""
@@ -154,7 +194,7 @@ class MCPClient:
         if params:
             payload["params"] = params
         
-        print(f"[DEBUG] MCP Request: {method}")
+        log.debug("MCP Request: %s", method)
         
         async with self.client.stream(
             "POST",
@@ -169,12 +209,22 @@ class MCPClient:
                 text = await response.aread()
                 raise Exception(f"HTTP {response.status_code}: {text.decode()}")
             
-            full_response = ""
-            async for chunk in response.aiter_text():
-                full_response += chunk
+            # Raw bytes in a growable buffer: appends are amortized O(1) instead of
+            # copying the whole accumulated string on every chunk
+            buffer = bytearray()
+            scanned = 0  # bytes of `buffer` already known not to contain the delimiter
+            async for chunk in response.aiter_bytes():
+                buffer += chunk
                 
-                if "\n\n" in full_response:
-                    parsed = parse_sse_response(full_response)
+                # Handle each complete event as it arrives; keep the partial tail.
+                # Only the new bytes are searched, plus one byte of overlap for a
+                # delimiter split across chunks.
+                while (end := buffer.find(b"\n\n", max(0, scanned - 1))) >= 0:
+                    with memoryview(buffer) as view:
+                        frame = bytes(view[:end])
+                    del buffer[:end + 2]
+                    scanned = 0
+                    parsed = parse_sse_response(frame)
                     if parsed:
                         if "error" in parsed:
                             error = parsed['error']
@@ -184,11 +234,11 @@ class MCPClient:
                         
                         if "result" in parsed:
                             return parsed["result"]
-                        
-                        full_response = ""
+                
+                scanned = len(buffer)
             
-            if full_response:
-                parsed = parse_sse_response(full_response)
+            if buffer:
+                parsed = parse_sse_response(bytes(buffer))
                 if parsed:
                     if "error" in parsed:
                         error = parsed['error']
@@ -200,9 +250,16 @@ class MCPClient:
             
             raise Exception("No valid response received from MCP server")
     
-    async def initialize(self) -> dict:
-        """Initialize MCP session with server."""
-        return await self.send_request("initialize", {
+    async def initialize(self, prefetch_tools: bool = False) -> dict:
+        """
+        Initialize MCP session with server.
+        
+        With `prefetch_tools`, tools/list is sent as soon as the handshake
+        returns (the MCP lifecycle asks clients not to send requests before
+        that) and runs in the background; list_tools() picks it up, or
+        re-sends it if the early request failed.
+        """
+        result = await self.send_request("initialize", {
             "protocolVersion": "2024-11-05",
             "capabilities": {},
             "clientInfo": {
@@ -210,9 +267,20 @@ class MCPClient:
                 "version": "1.0.0"
             }
         })
+        if prefetch_tools:
+            self._tools_prefetch = asyncio.create_task(self.send_request("tools/list"))
+        return result
     
     async def list_tools(self) -> List[dict]:
         """List all available tools from MCP server."""
+        prefetch, self._tools_prefetch = self._tools_prefetch, None
+        if prefetch is not None:
+            try:
+                result = await prefetch
+                return result.get("tools", [])
+            except Exception as e:
+                log.warning("Pipelined tools/list failed, retrying: %s", e)
+        
         result = await self.send_request("tools/list")
         return result.get("tools", [])
     
@@ -224,14 +292,189 @@ class MCPClient:
         })
     
     async def close(self):
-        """Close HTTP client connection."""
-        await self.client.aclose()
+        """Release the session; the shared HTTP pool is closed on app shutdown."""
+        prefetch, self._tools_prefetch = self._tools_prefetch, None
+        if prefetch is not None and not prefetch.done():
+            prefetch.cancel()
+            try:
+                await prefetch
+            except (asyncio.CancelledError, Exception):
+                pass
 
 
 # ============================================================================
 # Intelligent Tool Filtering
 # ============================================================================
 
+# Category keywords based on actual MCP tool files
+CATEGORY_KEYWORDS: Dict[str, List[str]] = {
+    # Device Management (device_tools.py)
+    'device': [
+        'device', 'fortigate', 'fgt', 'firmware', 'vdom', 'ha', 'hardware', 
+        'model', 'cluster', 'revision', 'serial', 'platform'
+    ],
+
+    # Policy Management (policy_tools.py)
+    'policy': [
+        'policy', 'firewall', 'rule', 'nat', 'snat', 'dnat', 'package', 
+        'install', 'central', 'consolidated'
+    ],
+
+    # Objects (object_tools.py, additional_object_tools.py, advanced_object_tools.py)
+    'object': [
+        'address', 'service', 'zone', 'vip', 'pool', 'schedule', 'wildcard', 
+        'fqdn', 'geography', 'addrgrp', 'service group', 'internet service'
+    ],
+
+    # Provisioning (provisioning_tools.py)
+    'provision': [
+        'template', 'provision', 'profile', 'cli template', 'system template', 
+        'certificate', 'widget', 'admin'
+    ],
+
+    # Monitoring (monitoring_tools.py)
+    'monitor': [
+        'monitor', 'status', 'log', 'statistic', 'health', 'task', 
+        'connectivity', 'performance', 'dashboard'
+    ],
+
+    # ADOM Management (adom_tools.py)
+    'adom': [
+        'adom', 'workspace', 'revision', 'lock', 'commit', 'assignment', 
+        'clone', 'administrative domain'
+    ],
+
+    # Security Profiles (security_tools.py)
+    'security': [
+        'webfilter', 'web filter', 'ips', 'antivirus', 'av', 'dlp', 
+        'application control', 'waf', 'email filter', 'profile group'
+    ],
+
+    # VPN Management (vpn_tools.py)
+    'vpn': [
+        'vpn', 'ipsec', 'ssl-vpn', 'ssl vpn', 'tunnel', 'phase1', 'phase2', 
+        'concentrator', 'forticlient'
+    ],
+
+    # SD-WAN (sdwan_tools.py)
+    'sdwan': [
+        'sd-wan', 'sdwan', 'sd wan', 'wan', 'health check', 'sla', 'link', 
+        'traffic class', 'wan profile'
+    ],
+
+    # Scripts (script_tools.py)
+    'script': [
+        'script', 'cli script', 'execute', 'run', 'jinja'
+    ],
+
+    # FortiGuard (fortiguard_tools.py)
+    'fortiguard': [
+        'fortiguard', 'update', 'contract', 'threat', 'database', 'license'
+    ],
+
+    # Installation (installation_tools.py from policy_tools.py)
+    'installation': [
+        'install', 'deploy', 'push', 'preview', 'validate', 'abort'
+    ],
+
+    # Workspace (workspace_tools.py)
+    'workspace': [
+        'lock', 'unlock', 'commit', 'workspace', 'revert'
+    ],
+
+    # Connectors (connector_tools.py)
+    'connector': [
+        'connector', 'fabric', 'aws', 'azure', 'vmware', 'sdn', 'cloud'
+    ],
+
+    # System (system_tools.py)
+    'system': [
+        'system', 'backup', 'restore', 'admin', 'certificate', 'interface',
+        'snmp', 'syslog', 'ntp', 'dns', 'route', 'global', 'static route',
+        'routing', 'gateway', 'routing_table', 'routing table', 'table', 'router'
+    ],
+
+    # Additional categories
+    'fortiap': ['fortiap', 'wtp', 'wireless', 'wifi', 'ssid'],
+    'fortiswitch': ['fortiswitch', 'switch', 'port'],
+    'fortiextender': ['fortiextender', 'extender', 'lte'],
+    'qos': ['qos', 'shaping', 'bandwidth', 'traffic shaping'],
+    'csf': ['csf', 'fabric topology', 'security fabric'],
+    'docker': ['docker', 'container'],
+    'metafield': ['meta', 'metadata', 'tag', 'custom field'],
+}
+
+# Operation types (verbs) recognised in queries and tool names
+OPERATION_TYPES: Dict[str, List[str]] = {
+    'list': ['list', 'get', 'show', 'view', 'retrieve', 'fetch'],
+    'create': ['create', 'add', 'new'],
+    'update': ['update', 'modify', 'edit', 'set', 'change'],
+    'delete': ['delete', 'remove'],
+    'install': ['install', 'deploy', 'push'],
+    'execute': ['execute', 'run', 'exec'],
+    'lock': ['lock', 'unlock'],
+    'commit': ['commit', 'revert'],
+}
+
+
+# High-priority entities: tools naming one the query mentions get an extra boost
+HIGH_PRIORITY_ENTITIES = frozenset({
+    'device', 'policy', 'firewall', 'address', 'service', 'adom', 
+    'vdom', 'template', 'vpn', 'sdwan', 'ha', 'cluster', 'package',
+    'script', 'install', 'workspace', 'route', 'static', 'router'
+})
+
+# Critical tools that should always be included
+CRITICAL_TOOLS = frozenset({
+    'list_devices',
+    'get_device_routing_table',
+    'list_adoms',
+    'list_policy_packages',
+    'list_firewall_policies',
+    'install_policy_package'
+})
+
+# Tools named like this only read state, so they may run concurrently; any other
+# call (lock, create, commit, install, ...) runs alone, in the order requested
+READ_ONLY_TOOL_PREFIXES = ('get_', 'list_', 'search_')
+
+
+def build_tool_index(tools: List[dict]) -> List[dict]:
+    """
+    Precompute the query-independent part of tool scoring.
+    
+    Lowercased name/description plus the categories and operation types each
+    tool matches are fixed for a tool catalog, so rank_tools() only has to
+    intersect them with what the query matches.
+    """
+    index = []
+    for tool in tools:
+        tool_name = tool.get("name", "").lower()
+        tool_desc = tool.get("description", "").lower()
+        index.append({
+            "name": tool_name,
+            "desc": tool_desc,
+            "name_categories": frozenset(
+                category for category, kws in CATEGORY_KEYWORDS.items()
+                if any(kw in tool_name for kw in kws)
+            ),
+            "desc_categories": frozenset(
+                category for category, kws in CATEGORY_KEYWORDS.items()
+                if any(kw in tool_desc for kw in kws)
+            ),
+            "name_operations": frozenset(
+                op_type for op_type, op_keywords in OPERATION_TYPES.items()
+                if any(op in tool_name for op in op_keywords)
+            ),
+        })
+    return index
+
+
+def default_tool_indices(tool_index: List[dict]) -> List[int]:
+    """Indices of the generic list/get tools offered when no tool scores for a query."""
+    return [i for i, entry in enumerate(tool_index) if 'list' in entry["name"] or 'get' in entry["name"]]
+
+
 def filter_relevant_tools(query: str, tools: List[dict], max_tools: int = 100) -> List[dict]:
     """
     Filter tools based on query relevance using category-aware scoring.
@@ -239,224 +482,274 @@ def filter_relevant_tools(query: str, tools: List[dict], max_tools: int = 100) -
     Reduces 590+ tools to ~100 most relevant for OpenAI's 128 tool limit.
     Based on actual FortiManager MCP tool implementation.
     """
+    return [tools[i] for i in rank_tools(query, tools, max_tools)]
+
+
+def rank_tools(
+    query: str,
+    tools: List[dict],
+    max_tools: int = 100,
+    tool_index: Optional[List[dict]] = None,
+    default_indices: Optional[List[int]] = None,
+) -> List[int]:
+    """
+    Return indices into `tools` of the most relevant tools, best first.
+    
+    Pass a `tool_index` from build_tool_index(tools) and the matching
+    default_tool_indices(tool_index) to reuse the per-tool precomputation
+    across queries.
+    """
+    if tool_index is None:
+        tool_index = build_tool_index(tools)
+    
     query_lower = query.lower()
-    keywords = query_lower.split()
-    
-    # Category keywords based on actual MCP tool files
-    category_keywords = {
-        # Device Management (device_tools.py)
-        'device': [
-            'device', 'fortigate', 'fgt', 'firmware', 'vdom', 'ha', 'hardware', 
-            'model', 'cluster', 'revision', 'serial', 'platform'
-        ],
-        
-        # Policy Management (policy_tools.py)
-        'policy': [
-            'policy', 'firewall', 'rule', 'nat', 'snat', 'dnat', 'package', 
-            'install', 'central', 'consolidated'
-        ],
-        
-        # Objects (object_tools.py, additional_object_tools.py, advanced_object_tools.py)
-        'object': [
-            'address', 'service', 'zone', 'vip', 'pool', 'schedule', 'wildcard', 
-            'fqdn', 'geography', 'addrgrp', 'service group', 'internet service'
-        ],
-        
-        # Provisioning (provisioning_tools.py)
-        'provision': [
-            'template', 'provision', 'profile', 'cli template', 'system template', 
-            'certificate', 'widget', 'admin'
-        ],
-        
-        # Monitoring (monitoring_tools.py)
-        'monitor': [
-            'monitor', 'status', 'log', 'statistic', 'health', 'task', 
-            'connectivity', 'performance', 'dashboard'
-        ],
-        
-        # ADOM Management (adom_tools.py)
-        'adom': [
-            'adom', 'workspace', 'revision', 'lock', 'commit', 'assignment', 
-            'clone', 'administrative domain'
-        ],
-        
-        # Security Profiles (security_tools.py)
-        'security': [
-            'webfilter', 'web filter', 'ips', 'antivirus', 'av', 'dlp', 
-            'application control', 'waf', 'email filter', 'profile group'
-        ],
-        
-        # VPN Management (vpn_tools.py)
-        'vpn': [
-            'vpn', 'ipsec', 'ssl-vpn', 'ssl vpn', 'tunnel', 'phase1', 'phase2', 
-            'concentrator', 'forticlient'
-        ],
-        
-        # SD-WAN (sdwan_tools.py)
-        'sdwan': [
-            'sd-wan', 'sdwan', 'sd wan', 'wan', 'health check', 'sla', 'link', 
-            'traffic class', 'wan profile'
-        ],
-        
-        # Scripts (script_tools.py)
-        'script': [
-            'script', 'cli script', 'execute', 'run', 'jinja'
-        ],
-        
-        # FortiGuard (fortiguard_tools.py)
-        'fortiguard': [
-            'fortiguard', 'update', 'contract', 'threat', 'database', 'license'
-        ],
-        
-        # Installation (installation_tools.py from policy_tools.py)
-        'installation': [
-            'install', 'deploy', 'push', 'preview', 'validate', 'abort'
-        ],
-        
-        # Workspace (workspace_tools.py)
-        'workspace': [
-            'lock', 'unlock', 'commit', 'workspace', 'revert'
-        ],
-        
-        # Connectors (connector_tools.py)
-        'connector': [
-            'connector', 'fabric', 'aws', 'azure', 'vmware', 'sdn', 'cloud'
-        ],
-        
-        # System (system_tools.py)
-        'system': [
-            'system', 'backup', 'restore', 'admin', 'certificate', 'interface',
-            'snmp', 'syslog', 'ntp', 'dns', 'route', 'global', 'static route',
-            'routing', 'gateway', 'routing_table', 'routing table', 'table', 'router'
-        ],
-        
-        # Additional categories
-        'fortiap': ['fortiap', 'wtp', 'wireless', 'wifi', 'ssid'],
-        'fortiswitch': ['fortiswitch', 'switch', 'port'],
-        'fortiextender': ['fortiextender', 'extender', 'lte'],
-        'qos': ['qos', 'shaping', 'bandwidth', 'traffic shaping'],
-        'csf': ['csf', 'fabric topology', 'security fabric'],
-        'docker': ['docker', 'container'],
-        'metafield': ['meta', 'metadata', 'tag', 'custom field'],
-    }
+    keywords = [kw for kw in query_lower.split() if len(kw) >= 3]
     
     # Detect relevant categories
-    detected_categories = set()
-    for category, category_kws in category_keywords.items():
-        if any(kw in query_lower for kw in category_kws):
-            detected_categories.add(category)
-    
-    # High-priority entities
-    high_priority = [
-        'device', 'policy', 'firewall', 'address', 'service', 'adom', 
-        'vdom', 'template', 'vpn', 'sdwan', 'ha', 'cluster', 'package',
-        'script', 'install', 'workspace', 'route', 'static', 'router'
-    ]
-    
-    # Critical tools that should always be included
-    critical_tools = [
-        'list_devices',
-        'get_device_routing_table',
-        'list_adoms',
-        'list_policy_packages',
-        'list_firewall_policies',
-        'install_policy_package'
-    ]
+    detected_categories = frozenset(
+        category for category, category_kws in CATEGORY_KEYWORDS.items()
+        if any(kw in query_lower for kw in category_kws)
+    )
+    query_operations = frozenset(
+        op_type for op_type, op_keywords in OPERATION_TYPES.items()
+        if any(op in query_lower for op in op_keywords)
+    )
+    
+    query_entities = [entity for entity in HIGH_PRIORITY_ENTITIES if entity in query_lower]
     
     # Score tools
-    scored_tools: List[Tuple[int, dict]] = []
+    scored_tools: List[Tuple[int, int]] = []
     
-    for tool in tools:
+    for index, (tool, entry) in enumerate(zip(tools, tool_index)):
         score = 0
-        tool_name = tool.get("name", "").lower()
-        tool_desc = tool.get("description", "").lower()
+        tool_name = entry["name"]
+        tool_desc = entry["desc"]
         
         # Critical tools always get highest priority
-        if tool.get("name") in critical_tools:
+        if tool.get("name") in CRITICAL_TOOLS:
             score += 50
         
         # Category match
-        for category in detected_categories:
-            if any(kw in tool_name for kw in category_keywords[category]):
-                score += 15
-            if any(kw in tool_desc for kw in category_keywords[category]):
-                score += 5
+        score += 15 * len(detected_categories & entry["name_categories"])
+        score += 5 * len(detected_categories & entry["desc_categories"])
         
         # Keyword match
         for keyword in keywords:
-            if len(keyword) >= 3:
-                if keyword in tool_name:
-                    score += 10
-                if keyword in tool_desc:
-                    score += 3
+            if keyword in tool_name:
+                score += 10
+            if keyword in tool_desc:
+                score += 3
         
         # Operation type
-        operation_types = {
-            'list': ['list', 'get', 'show', 'view', 'retrieve', 'fetch'],
-            'create': ['create', 'add', 'new'],
-            'update': ['update', 'modify', 'edit', 'set', 'change'],
-            'delete': ['delete', 'remove'],
-            'install': ['install', 'deploy', 'push'],
-            'execute': ['execute', 'run', 'exec'],
-            'lock': ['lock', 'unlock'],
-            'commit': ['commit', 'revert'],
-        }
-        
-        for op_type, op_keywords in operation_types.items():
-            if any(op in query_lower for op in op_keywords):
-                if any(op in tool_name for op in op_keywords):
-                    score += 8
+        score += 8 * len(query_operations & entry["name_operations"])
         
         # High-priority entity boost
-        for entity in high_priority:
-            if entity in query_lower and entity in tool_name:
+        for entity in query_entities:
+            if entity in tool_name:
                 score += 12
         
         if score > 0:
-            scored_tools.append((score, tool))
-    
-    scored_tools.sort(reverse=True, key=lambda x: x[0])
+            scored_tools.append((score, index))
     
     if not scored_tools:
-        default_tools = [t for t in tools if any(op in t.get("name", "").lower() for op in ['list', 'get'])]
-        return default_tools[:max_tools]
+        if default_indices is None:
+            default_indices = default_tool_indices(tool_index)
+        return default_indices[:max_tools]
     
-    return [tool for score, tool in scored_tools[:max_tools]]
+    # Same order as a stable descending sort, without sorting every scored tool
+    return [index for score, index in heapq.nlargest(max_tools, scored_tools, key=lambda x: x[0])]
+
+
+@lru_cache(maxsize=256)
+def select_tool_indices(query_key: str, max_tools: int = 100) -> Tuple[int, ...]:
+    """
+    Cached rank_tools() over the session tool catalog.
+    
+    `query_key` is the lowercased, whitespace-normalized query; the cache must be
+    cleared whenever `all_tools` is replaced.
+    """
+    return tuple(rank_tools(query_key, all_tools, max_tools, tool_index, default_indices))
+
+
+# Conversational messages that are answered without tool schemas. Anything
+# else may concern a device or object (e.g. "Is FGT-001 online?"), so it gets tools.
+_NO_TOOL_QUERIES = frozenset({
+    'hi', 'hello', 'hey', 'hi there', 'hello there', 'hey there',
+    'good morning', 'good afternoon', 'good evening',
+    'thanks', 'thank you', 'thanks a lot', 'thank you very much', 'thx', 'ty',
+    'ok', 'okay', 'cool', 'great', 'nice', 'perfect',
+    'bye', 'goodbye', 'see you',
+})
+
+
+def query_needs_tools(query_key: str) -> bool:
+    """
+    Cheap pre-classifier: should this (normalized) query be sent with tools?
+    
+    Only bare greetings, thanks and acknowledgements skip the tool schemas;
+    every other query gets the filtered tool list.
+    """
+    return query_key.strip(" .,;:!?'\"()") not in _NO_TOOL_QUERIES
+
+
+def to_openai_tool(tool: dict) -> dict:
+    """Convert an MCP tool definition to the OpenAI function-calling format."""
+    return openai_tool(tool.get("name", ""), tool.get("description"), tool.get("inputSchema"))
 
 
 # ============================================================================
 # MCP Session Management
 # ============================================================================
 
-async def init_mcp_session() -> Optional[MCPClient]:
-    """Initialize connection to FortiManager MCP server."""
+async def init_mcp_session(timeout: float = 15.0) -> Optional[MCPClient]:
+    """
+    Initialize connection to FortiManager MCP server.
+    
+    Raises TimeoutError if the handshake takes longer than `timeout` seconds.
+    """
     try:
-        print(f"[INFO] Connecting to MCP server at {MCP_SERVER_URL}")
+        log.info("Connecting to MCP server at %s", MCP_SERVER_URL)
         mcp = MCPClient(MCP_SERVER_URL)
         
-        print("[INFO] Initializing MCP session...")
-        init_result = await mcp.initialize()
+        log.info("Initializing MCP session...")
+        async with asyncio.timeout(timeout):
+            init_result = await mcp.initialize(prefetch_tools=True)
         
         server_name = init_result.get('serverInfo', {}).get('name', 'Unknown')
         server_version = init_result.get('serverInfo', {}).get('version', 'Unknown')
-        print(f"[INFO] Connected to: {server_name} v{server_version}")
+        log.info("Connected to: %s v%s", server_name, server_version)
         
         return mcp
+    except TimeoutError:
+        raise
     except Exception as e:
-        print(f"[ERROR] MCP connection failed: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("MCP connection failed: %s", e)
         return None
 
 
+# Serializes the first connection so concurrent chat starts share one handshake
+_mcp_init_lock = asyncio.Lock()
+
+
+async def get_mcp_session(timeout: float = 15.0) -> Optional[MCPClient]:
+    """
+    The process-wide MCP session, connecting on first use.
+    
+    Every chat talks to the same server, so one session (and the HTTP pool
+    behind it) serves all users. A failed connection is retried by the next
+    caller. Raises TimeoutError like init_mcp_session().
+    """
+    global mcp_session
+    async with _mcp_init_lock:
+        if mcp_session is None:
+            mcp_session = await init_mcp_session(timeout)
+        return mcp_session
+
+
+def tool_calls_banner(tool_calls: List[dict]) -> str:
+    """One chat message announcing every tool call of an assistant turn."""
+    return "\n".join(
+        f"🔧 **{tool_call['function']['name']}**\n"
+        f"```json\n{format_raw_tool_arguments(tool_call['function']['arguments'])}\n```"
+        for tool_call in tool_calls
+    )
+
+
+async def execute_tool_call(mcp: MCPClient, tool_call: dict) -> str:
+    """Execute one OpenAI tool call on the MCP server and return the tool output text."""
+    tool_name = tool_call["function"]["name"]
+    
+    try:
+        # Malformed arguments fail only this call, not its siblings in the turn
+        tool_args = parse_tool_arguments(tool_call["function"]["arguments"])
+        log.info("Calling: %s with %s", tool_name, tool_args)
+        
+        result = await mcp.call_tool(tool_name, tool_args)
+        
+        if isinstance(result, dict):
+            if "content" in result:
+                content = result["content"]
+                if isinstance(content, list) and content:
+                    # Large outputs can be split across several content items: join them once.
+                    # Images and other binary items stay out of the prompt.
+                    tool_response = "\n".join(
+                        item.get("text", "") if isinstance(item, dict) and item.get("type") == "text"
+                        else "[Image Returned]"
+                        for item in content
+                    )
+                else:
+                    tool_response = str(content)
+            else:
+                tool_response = json_dumps_pretty(result)
+        else:
+            tool_response = str(result)
+        
+        log.info("Tool %s succeeded, response length: %d", tool_name, len(tool_response))
+        return tool_response
+        
+    except Exception as e:
+        error_msg = f"Error calling {tool_name}: {str(e)}"
+        log.error("%s", error_msg)
+        await cl.Message(content=f"⚠️ {error_msg}").send()
+        return error_msg
+
+
+async def execute_tool_calls(mcp: MCPClient, tool_calls: List[dict]) -> List[str]:
+    """
+    Execute one assistant turn's tool calls and return their outputs in call order.
+    
+    FortiManager workflows depend on order (lock the workspace, change, commit,
+    unlock, install), so mutating calls run one at a time in the order the
+    model gave them. Consecutive read-only calls between them run concurrently.
+    """
+    tool_responses: List[str] = []
+    reads: List[dict] = []
+    
+    async def flush_reads():
+        tool_responses.extend(await asyncio.gather(*(
+            execute_tool_call(mcp, tool_call) for tool_call in reads
+        )))
+        reads.clear()
+    
+    for tool_call in tool_calls:
+        if tool_call["function"]["name"].startswith(READ_ONLY_TOOL_PREFIXES):
+            reads.append(tool_call)
+            continue
+        await flush_reads()
+        tool_responses.append(await execute_tool_call(mcp, tool_call))
+    await flush_reads()
+    return tool_responses
+
+
 # ============================================================================
 # Chainlit Event Handlers
 # ============================================================================
 
+# Catalog summary shown on chat start, matched against lowercased tool names
+TOOL_SUMMARY_CATEGORIES: List[Tuple[str, Callable[[str], bool]]] = [
+    ('Device Management', lambda t: any(k in t for k in ('device', 'vdom', 'ha', 'firmware'))),
+    ('ADOM Management', lambda t: 'adom' in t),
+    ('Policy Management', lambda t: any(k in t for k in ('policy', 'package'))),
+    ('Firewall Objects', lambda t: any(k in t for k in ('address', 'service', 'zone', 'vip')) and 'internet' not in t),
+    ('Security Profiles', lambda t: any(k in t for k in ('ips', 'antivirus', 'webfilter', 'dlp', 'waf', 'profile_group'))),
+    ('VPN Management', lambda t: 'vpn' in t or 'ipsec' in t),
+    ('SD-WAN', lambda t: 'sdwan' in t or 'wan' in t or 'traffic_class' in t),
+    ('Installation', lambda t: 'install' in t),
+    ('Workspace & Locking', lambda t: any(k in t for k in ('lock', 'unlock', 'commit', 'workspace'))),
+    ('CLI Scripts', lambda t: 'script' in t),
+    ('Monitoring & Tasks', lambda t: any(k in t for k in ('monitor', 'status', 'log', 'task', 'statistic'))),
+    ('FortiGuard', lambda t: 'fortiguard' in t or 'update' in t),
+    ('Internet Services', lambda t: 'internet_service' in t),
+    ('Connectors', lambda t: 'connector' in t or 'sdn' in t or 'fabric' in t),
+    ('Provisioning', lambda t: 'template' in t or 'provision' in t),
+    ('System', lambda t: any(k in t for k in ('system', 'backup', 'certificate', 'admin'))),
+]
+
+
 @cl.on_chat_start
 async def start():
     """Initialize when user starts a new chat."""
-    global mcp_session, all_tools
+    global all_tools, openai_tools_all, tool_index, default_indices
     
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key or "REPLACE" in api_key:
@@ -469,54 +762,55 @@ async def start():
         ).send()
         return
     
-    await cl.Message(
-        content=f"🔄 **Connecting to FortiManager MCP...**\n*Server: `{MCP_SERVER_URL}`*"
-    ).send()
+    mcp_task = asyncio.create_task(get_mcp_session(timeout=15.0))
+    
+    # A fast handshake gets a single result message; only a slow one shows progress first
+    done, _ = await asyncio.wait({mcp_task}, timeout=0.5)
+    if not done:
+        await cl.Message(
+            content=f"🔄 **Connecting to FortiManager MCP...**\n*Server: `{MCP_SERVER_URL}`*"
+        ).send()
     
     try:
-        mcp_session = await asyncio.wait_for(init_mcp_session(), timeout=15.0)
-    except asyncio.TimeoutError:
+        mcp = await mcp_task
+    except TimeoutError:
+        log.error("MCP handshake with %s timed out", MCP_SERVER_URL)
         await cl.Message(content="❌ **Connection timeout**\nCheck MCP server status").send()
         return
     
-    if not mcp_session:
+    if not mcp:
         await cl.Message(content="❌ **Connection failed**\nCheck terminal logs").send()
         return
     
     try:
-        print("[INFO] Fetching tool catalog...")
-        all_tools = await asyncio.wait_for(mcp_session.list_tools(), timeout=15.0)
-        
+        # The catalog belongs to the shared session: only the first chat loads it
         if not all_tools:
-            await cl.Message(content="⚠️ **No tools available**").send()
-            return
-        
-        tool_names = [tool.get("name", "unknown") for tool in all_tools]
-        
-        # Categorize based on actual tool names
-        categories = {
-            'Device Management': [t for t in tool_names if any(k in t for k in ['device', 'vdom', 'ha', 'firmware'])],
-            'ADOM Management': [t for t in tool_names if 'adom' in t],
-            'Policy Management': [t for t in tool_names if any(k in t for k in ['policy', 'package'])],
-            'Firewall Objects': [t for t in tool_names if any(k in t for k in ['address', 'service', 'zone', 'vip']) and 'internet' not in t],
-            'Security Profiles': [t for t in tool_names if any(k in t for k in ['ips', 'antivirus', 'webfilter', 'dlp', 'waf', 'profile_group'])],
-            'VPN Management': [t for t in tool_names if 'vpn' in t or 'ipsec' in t],
-            'SD-WAN': [t for t in tool_names if 'sdwan' in t or 'wan' in t or 'traffic_class' in t],
-            'Installation': [t for t in tool_names if 'install' in t],
-            'Workspace & Locking': [t for t in tool_names if any(k in t for k in ['lock', 'unlock', 'commit', 'workspace'])],
-            'CLI Scripts': [t for t in tool_names if 'script' in t],
-            'Monitoring & Tasks': [t for t in tool_names if any(k in t for k in ['monitor', 'status', 'log', 'task', 'statistic'])],
-            'FortiGuard': [t for t in tool_names if 'fortiguard' in t or 'update' in t],
-            'Internet Services': [t for t in tool_names if 'internet_service' in t],
-            'Connectors': [t for t in tool_names if 'connector' in t or 'sdn' in t or 'fabric' in t],
-            'Provisioning': [t for t in tool_names if 'template' in t or 'provision' in t],
-            'System': [t for t in tool_names if any(k in t for k in ['system', 'backup', 'certificate', 'admin'])],
-        }
+            log.info("Fetching tool catalog...")
+            async with asyncio.timeout(15.0):
+                tools = await mcp.list_tools()
+            
+            if not tools:
+                await cl.Message(content="⚠️ **No tools available**").send()
+                return
+            
+            # Tool metadata is static for the session: convert it once, not per message
+            openai_tools_all = [to_openai_tool(t) for t in tools]
+            tool_index = build_tool_index(tools)
+            default_indices = default_tool_indices(tool_index)
+            all_tools = tools
+            select_tool_indices.cache_clear()
+        
+        # Categorize based on actual tool names in a single pass over the catalog
+        category_counts = dict.fromkeys((label for label, _ in TOOL_SUMMARY_CATEGORIES), 0)
+        for entry in tool_index:
+            for label, matches in TOOL_SUMMARY_CATEGORIES:
+                if matches(entry["name"]):
+                    category_counts[label] += 1
         
-        message = f"✅ **Connected!** Total tools: **{len(tool_names)}**\n\n**By category:**\n"
-        for cat, tools_list in categories.items():
-            if tools_list:
-                message += f"• **{cat}:** {len(tools_list)}\n"
+        message = f"✅ **Connected!** Total tools: **{len(all_tools)}**\n\n**By category:**\n"
+        for cat, count in category_counts.items():
+            if count:
+                message += f"• **{cat}:** {count}\n"
         
         message += (
             "\n**Example queries:**\n"
@@ -533,9 +827,8 @@ async def start():
         await cl.Message(content=message).send()
         
     except Exception as e:
+        log.exception("Error loading tools")
         await cl.Message(content=f"⚠️ Error loading tools: {str(e)}").send()
-        import traceback
-        traceback.print_exc()
 
 
 @cl.on_message
@@ -549,27 +842,26 @@ async def on_message(message: cl.Message):
     
     try:
         # Filter tools
-        relevant_tools = filter_relevant_tools(message.content, all_tools, max_tools=100)
-        print(f"[INFO] Filtered to {len(relevant_tools)}/{len(all_tools)} tools")
-        
-        if relevant_tools:
-            top_10 = [t.get("name") for t in relevant_tools[:10]]
-            print(f"[DEBUG] Top 10 tools: {top_10}")
+        query_key = " ".join(message.content.lower().split())
+        if query_needs_tools(query_key):
+            tool_indices = select_tool_indices(query_key, max_tools=100)
+            log.info("Filtered to %d/%d tools", len(tool_indices), len(all_tools))
+            
+            if tool_indices:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Top 10 tools: %s", [all_tools[i].get("name") for i in tool_indices[:10]])
+            else:
+                await cl.Message(content="⚠️ No relevant tools found").send()
+                return
+            
+            openai_tools = [openai_tools_all[i] for i in tool_indices]
         else:
-            await cl.Message(content="⚠️ No relevant tools found").send()
-            return
-        
-        # Convert to OpenAI format
-        openai_tools = [{
-            "type": "function",
-            "function": {
-                "name": t.get("name", ""),
-                "description": t.get("description", "")[:1000],
-                "parameters": t.get("inputSchema", {})
-            }
-        } for t in relevant_tools]
+            # Conversational turn: skip the tool schemas entirely
+            log.info("No tool intent in query, answering without tools")
+            openai_tools = []
         
-        print(f"[DEBUG] Sending {len(openai_tools)} tools to OpenAI")
+        log.debug("Sending %d tools to OpenAI", len(openai_tools))
+        tool_params = {"tools": openai_tools} if openai_tools else {}
         
         messages = [
             {
@@ -706,29 +998,38 @@ async def on_message(message: cl.Message):
             {"role": "user", "content": message.content}
         ]
         
-        response = client.chat.completions.create(
+        # Stream the reply so text shows up as soon as the first tokens arrive
+        reply = cl.Message(content="")
+        content, tool_calls = await stream_chat_completion(
+            client,
+            reply,
             model=MODEL,
-            messages=messages,
-            tools=openai_tools if openai_tools else None,
-            tool_choice="auto",
+            messages=trim_messages(messages),
+            **tool_params,
+            **({"tool_choice": "auto"} if openai_tools else {}),
             temperature=0.1  # Lower for more focused, deterministic responses
         )
         
         # Check if OpenAI called any tools
-        if not response.choices[0].message.tool_calls:
-            print("[WARN] OpenAI did not call any tools")
-            print(f"[WARN] Response: {response.choices[0].message.content[:200]}")
+        if not tool_calls:
+            log.warning("OpenAI did not call any tools")
+            log.warning("Response: %.200s", content)
         else:
-            print(f"[DEBUG] OpenAI called {len(response.choices[0].message.tool_calls)} tools")
+            log.debug("OpenAI called %d tools", len(tool_calls))
         
         max_iterations = 10  # Increased for complex FortiManager operations
         iteration = 0
+        # Tool-call banners still being sent; they overlap the tool calls and the next completion
+        status_tasks: List[asyncio.Task] = []
         
-        while response.choices[0].message.tool_calls and iteration < max_iterations:
+        while tool_calls and iteration < max_iterations:
             iteration += 1
-            assistant_message = response.choices[0].message
             
-            print(f"[INFO] Iteration {iteration}/{max_iterations}: {len(assistant_message.tool_calls)} tool calls")
+            log.info("Iteration %d/%d: %d tool calls", iteration, max_iterations, len(tool_calls))
+            
+            # Close out any text the model streamed alongside its tool calls
+            if content:
+                await reply.send()
             
             # Warn user if approaching limit
             if iteration >= max_iterations - 2:
@@ -738,62 +1039,40 @@ async def on_message(message: cl.Message):
             
             messages.append({
                 "role": "assistant",
-                "content": assistant_message.content,
-                "tool_calls": [{
-                    "id": tc.id,
-                    "type": "function",
-                    "function": {"name": tc.function.name, "arguments": tc.function.arguments}
-                } for tc in assistant_message.tool_calls]
+                "content": content or None,
+                "tool_calls": tool_calls
             })
             
-            for tool_call in assistant_message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
-                
-                print(f"[INFO] Calling: {tool_name} with {tool_args}")
-                
-                await cl.Message(
-                    content=f"🔧 **{tool_name}**\n```json\n{json.dumps(tool_args, indent=2)}\n```"
-                ).send()
-                
-                try:
-                    result = await mcp_session.call_tool(tool_name, tool_args)
-                    
-                    if isinstance(result, dict):
-                        if "content" in result:
-                            content = result["content"]
-                            tool_response = content[0].get("text", str(content)) if isinstance(content, list) and content else str(content)
-                        else:
-                            tool_response = json.dumps(result, indent=2)
-                    else:
-                        tool_response = str(result)
-                    
-                    print(f"[INFO] Tool {tool_name} succeeded, response length: {len(tool_response)}")
-                    
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": tool_response
-                    })
-                    
-                except Exception as e:
-                    error_msg = f"Error calling {tool_name}: {str(e)}"
-                    print(f"[ERROR] {error_msg}")
-                    await cl.Message(content=f"⚠️ {error_msg}").send()
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": error_msg
-                    })
+            # One banner for the whole round, sent in the background so the
+            # tool calls don't wait on a UI round-trip
+            status_tasks.append(asyncio.create_task(
+                cl.Message(content=tool_calls_banner(tool_calls)).send()
+            ))
+            
+            # Read-only calls run concurrently; mutating ones in order, one at a time
+            tool_responses = await execute_tool_calls(mcp_session, tool_calls)
             
-            response = client.chat.completions.create(
+            for tool_call, tool_response in zip(tool_calls, tool_responses):
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call["id"],
+                    "content": truncate_tool_output(tool_response)
+                })
+            
+            reply = cl.Message(content="")
+            content, tool_calls = await stream_chat_completion(
+                client,
+                reply,
                 model=MODEL,
-                messages=messages,
-                tools=openai_tools if openai_tools else None,
+                messages=trim_messages(messages),
+                **tool_params,
                 temperature=0.1  # Lower for more focused responses
             )
         
-        if iteration >= max_iterations and response.choices[0].message.tool_calls:
+        # Every banner is on screen before the closing messages
+        await asyncio.gather(*status_tasks, return_exceptions=True)
+        
+        if iteration >= max_iterations and tool_calls:
             await cl.Message(
                 content=(
                     f"⚠️ **Reached iteration limit ({max_iterations})**\n\n"
@@ -807,28 +1086,34 @@ async def on_message(message: cl.Message):
                 )
             ).send()
         
-        if response.choices[0].message.content:
-            await cl.Message(content=response.choices[0].message.content).send()
+        if content:
+            await reply.send()  # Ends the token stream and persists the message
         else:
             await cl.Message(content="✅ Operation completed").send()
             
     except Exception as e:
+        log.exception("Error handling message")
         await cl.Message(content=f"❌ Error: {str(e)}").send()
-        import traceback
-        traceback.print_exc()
 
 
-@cl.on_chat_end
-async def end():
-    """Cleanup when chat ends."""
-    global mcp_session
+async def close_mcp_session(mcp: MCPClient):
+    """Close an MCP session, giving an unresponsive server at most 2 seconds."""
+    try:
+        await asyncio.wait_for(mcp.close(), timeout=2.0)
+        log.info("MCP connection closed")
+    except asyncio.TimeoutError:
+        log.warning("MCP connection close timed out")
+    except Exception as e:
+        log.error("Cleanup error: %s", e)
+
+
+@cl.on_app_shutdown
+async def shutdown():
+    """Close the shared MCP session and HTTP connection pools."""
     if mcp_session:
-        try:
-            await mcp_session.close()
-            print("[INFO] MCP connection closed")
-        except Exception as e:
-            print(f"[ERROR] Cleanup error: {e}")
-    mcp_session = None
+        await close_mcp_session(mcp_session)
+    await HTTPX.aclose()
+    await OPENAI_HTTPX.aclose()
 
 
 # ============================================================================
@@ -0,0 +1,559 @@
+# mcp_common.py
+"""
+Shared helpers for the Chainlit MCP apps (app.py, notes_app_chainlit.py).
+
+Both apps drive the same OpenAI tool-calling loop over different MCP
+transports; everything that does not depend on the transport lives here so
+a fix or optimization only has to be made once:
+
+  • uvloop event loop policy (opt-in with USE_UVLOOP=1; breaks nest_asyncio re-entrance)
+  • Logging through a background writer thread (LOG_LEVEL, default INFO)
+  • Tuned HTTP connection pool for OpenAI API calls (HTTP/2 when 'h2' is installed)
+  • JSON helpers with optional orjson, memoized tool-argument parsing and banners
+  • MCP → OpenAI tool definition conversion, optional argument validation
+  • Streaming chat completions with tool-call delta merging
+  • Opt-in in-process LRU of completed responses (RESPONSE_CACHE_SIZE, off by default)
+  • Opt-in semantic cache of final replies (SEMANTIC_CACHE_THRESHOLD)
+  • Conversation budget: history trimming and tool-output truncation
+"""
+
+import os
+import sys
+import copy
+import json
+import hashlib
+import queue
+import atexit
+import asyncio
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, List, Dict, Tuple, Callable
+from functools import lru_cache
+from collections import OrderedDict
+
+# Opt-in: run Chainlit on uvloop when it is installed (set before Chainlit creates
+# its loop). Off by default because the 'chainlit run' CLI calls
+# nest_asyncio.apply() to make the stock asyncio loop re-entrant, and
+# nest_asyncio cannot patch a uvloop loop: cl.run_sync and other re-entrant
+# paths fail under USE_UVLOOP=1.
+if os.getenv("USE_UVLOOP", "0") == "1":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+import chainlit as cl
+from openai import AsyncOpenAI
+import httpx
+
+# HTTP/2 is only negotiated when the optional 'h2' package is installed
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+# Connection pool for OpenAI API calls (pass as AsyncOpenAI(http_client=...)).
+# A tool-calling turn makes several back-to-back completions, so connections
+# are kept alive between them and, over HTTP/2, multiplexed on one socket.
+OPENAI_HTTPX = httpx.AsyncClient(
+    http2=HTTP2_ENABLED,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200, keepalive_expiry=60.0),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+
+# Prompt budget: older tool rounds are dropped once the conversation exceeds
+# MAX_HISTORY_TOKENS, and single tool outputs are cut to MAX_TOOL_OUTPUT_CHARS
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "32000"))
+MAX_TOOL_OUTPUT_CHARS = int(os.getenv("MAX_TOOL_OUTPUT_CHARS", "20000"))
+
+# Exact token counts need the optional 'tiktoken' package; otherwise estimate
+try:
+    import tiktoken
+    try:
+        _encoding = tiktoken.encoding_for_model(os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+    except KeyError:
+        _encoding = tiktoken.get_encoding("o200k_base")
+except ImportError:
+    _encoding = None
+
+# orjson is optional; it parses/serializes large tool payloads several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Tool arguments can be checked against the tool's input schema before dispatch:
+# compiled with 'fastjsonschema' when installed, else interpreted by 'jsonschema'
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Identical chat requests are answered from memory when this is above 0. Off
+# by default: the cache is shared by every chat and user, replays stored
+# replies (tool_call ids included) and so hides the model's nondeterminism,
+# which means re-asking a question never yields a fresh answer
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "0"))
+
+# Near-duplicate user questions are answered from a per-chat semantic cache when
+# their embeddings' cosine similarity reaches this threshold; 0 disables it
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "128"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+
+# ============================================================================
+# Logging
+# ============================================================================
+
+_log_queue_handler: Optional[QueueHandler] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Return a logger whose records are written to stdout by a background thread.
+    
+    Writing to a slow terminal or log-collector pipe from the event loop stalls
+    every session, so handlers only enqueue records and a single QueueListener
+    does the actual I/O. Output keeps the "[LEVEL] message" format.
+    """
+    global _log_queue_handler
+    if _log_queue_handler is None:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+        listener = QueueListener(log_queue, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        _log_queue_handler = QueueHandler(log_queue)
+    
+    logger = logging.getLogger(name)
+    if _log_queue_handler not in logger.handlers:
+        logger.addHandler(_log_queue_handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False  # Chainlit configures the root logger too
+    return logger
+
+
+log = get_logger("mcp_common")
+
+
+# ============================================================================
+# JSON Helpers
+# ============================================================================
+
+def json_loads(data):
+    """Parse JSON with orjson when available, falling back to the stdlib."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN/Infinity, which only the stdlib parser accepts
+    return json.loads(data)
+
+
+def json_dumps_pretty(obj) -> str:
+    """Serialize to indented JSON with orjson when available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+        except TypeError:
+            pass  # e.g. non-string keys, which only the stdlib serializer accepts
+    return json.dumps(obj, indent=2)
+
+
+def format_tool_arguments(args: dict) -> str:
+    """
+    Render tool-call arguments for the chat banner.
+    
+    Small flat objects go on one line; only nested or larger ones pay for
+    indentation.
+    """
+    if len(args) < 4 and not any(isinstance(v, (dict, list)) for v in args.values()):
+        if orjson is not None:
+            try:
+                return orjson.dumps(args).decode()
+            except TypeError:
+                pass
+        return json.dumps(args)
+    return json_dumps_pretty(args)
+
+
+def json_dumps_canonical(obj) -> bytes:
+    """Serialize to compact JSON bytes with sorted keys, for hashing."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str).encode()
+
+
+# Tool-call argument strings up to this size are memoized by parse_tool_arguments()
+MAX_CACHED_ARGUMENTS_LEN = 64 * 1024
+
+
+@lru_cache(maxsize=128)
+def _parse_arguments_cached(raw: str) -> dict:
+    return json_loads(raw)
+
+
+def parse_tool_arguments(raw: str) -> dict:
+    """
+    Parse the JSON arguments of a tool call.
+    
+    Identical argument strings recur across iterations and retries, so small
+    ones are served from an LRU cache. The returned dict may be shared between
+    calls and must not be mutated.
+    """
+    if len(raw) > MAX_CACHED_ARGUMENTS_LEN:
+        return json_loads(raw)
+    return _parse_arguments_cached(raw)
+
+
+def _render_raw_arguments(raw: str) -> str:
+    try:
+        args = json_loads(raw)
+    except ValueError:
+        return raw  # malformed JSON from the model is shown as sent
+    if isinstance(args, dict):
+        return format_tool_arguments(args)
+    return json_dumps_pretty(args)
+
+
+@lru_cache(maxsize=256)
+def _format_arguments_cached(raw: str) -> str:
+    return _render_raw_arguments(raw)
+
+
+def format_raw_tool_arguments(raw: str) -> str:
+    """
+    Render the raw JSON arguments of a tool call for the chat banner.
+    
+    Keyed on the string the model sent, so repeated calls such as list_notes
+    with the same arguments reuse the rendered banner text instead of
+    re-serializing it. Never raises: arguments that are not valid JSON are
+    returned unchanged.
+    """
+    if len(raw) > MAX_CACHED_ARGUMENTS_LEN:
+        return _render_raw_arguments(raw)
+    return _format_arguments_cached(raw)
+
+
+# ============================================================================
+# Tool Definitions & Chat Completions
+# ============================================================================
+
+def openai_tool(name: str, description: Optional[str], parameters: Optional[dict]) -> dict:
+    """
+    Build an OpenAI function-calling tool definition from MCP tool metadata.
+    
+    Schema keys are put in sorted order so the serialized tool list is
+    byte-identical across requests and OpenAI's prompt cache can match it.
+    """
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": (description or "")[:1000],
+            "parameters": json_loads(json_dumps_canonical(parameters)) if parameters else {}
+        }
+    }
+
+
+def compile_validator(schema: Optional[dict]) -> Optional[Callable[[dict], Optional[str]]]:
+    """
+    Build a checker for tool arguments from an MCP input schema.
+    
+    The checker returns None for valid arguments, else the validation error
+    message. Build it once per tool when the server connects; fastjsonschema
+    generates Python code for the schema, which is much faster per call than
+    interpreting it. Returns None when neither validator package is installed
+    or the schema cannot be compiled, in which case calls go out unchecked.
+    """
+    if not schema:
+        return None
+    
+    if fastjsonschema is not None:
+        try:
+            # use_default=False: defaults would be written into the (shared,
+            # possibly cached) arguments dict instead of left to the server
+            validate = fastjsonschema.compile(schema, use_default=False)
+        except Exception as e:  # unsupported or invalid schema
+            log.warning("Cannot compile tool schema, arguments won't be checked: %s", e)
+            return None
+        
+        def check(args: dict) -> Optional[str]:
+            try:
+                validate(args)
+            except fastjsonschema.JsonSchemaException as e:
+                return e.message
+            return None
+        return check
+    
+    if jsonschema is not None:
+        try:
+            validator_cls = jsonschema.validators.validator_for(schema)
+            validator_cls.check_schema(schema)
+            validator = validator_cls(schema)
+        except jsonschema.SchemaError as e:
+            log.warning("Invalid tool schema, arguments won't be checked: %s", e.message)
+            return None
+        
+        def check(args: dict) -> Optional[str]:
+            error = jsonschema.exceptions.best_match(validator.iter_errors(args))
+            return error.message if error is not None else None
+        return check
+    
+    return None
+
+
+async def stream_chat_completion(
+    client: AsyncOpenAI, msg: cl.Message, **params
+) -> Tuple[str, List[dict]]:
+    """
+    Stream a chat completion from `client` into `msg` and return (content, tool_calls).
+    
+    Text deltas are forwarded to the UI as they arrive; tool-call deltas are
+    merged by index into OpenAI-format tool_call dicts.
+    """
+    stream = await client.chat.completions.create(stream=True, **params)
+    
+    content_parts: List[str] = []
+    tool_calls: Dict[int, dict] = {}
+    
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        
+        if delta.content:
+            content_parts.append(delta.content)
+            await msg.stream_token(delta.content)
+        
+        for tc in delta.tool_calls or []:
+            call = tool_calls.setdefault(tc.index, {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tc.id:
+                call["id"] = tc.id
+            if tc.function:
+                if tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+    
+    return "".join(content_parts), [tool_calls[i] for i in sorted(tool_calls)]
+
+
+# ============================================================================
+# Response Cache
+# ============================================================================
+
+_response_cache: "OrderedDict[str, Tuple[str, List[dict]]]" = OrderedDict()
+
+
+def tools_digest(openai_tools: List[dict]) -> str:
+    """
+    Digest of the full tool definitions, serialized once.
+    
+    Compute it whenever the tool set changes and pass it to
+    cached_chat_completion() so per-call cache keys skip the tool schemas.
+    """
+    return hashlib.blake2b(json_dumps_canonical(openai_tools), digest_size=16).hexdigest()
+
+
+def response_cache_key(params: dict, tools_key: Optional[str] = None) -> str:
+    """Digest of what determines a completion: model, messages, tools and sampling."""
+    key_data = {
+        "model": params.get("model"),
+        "messages": params.get("messages"),
+        "tools": tools_key if tools_key is not None else [
+            tool["function"]["name"] for tool in params.get("tools") or []
+        ],
+        "tool_choice": params.get("tool_choice"),
+        "temperature": params.get("temperature"),
+    }
+    return hashlib.blake2b(json_dumps_canonical(key_data), digest_size=16).hexdigest()
+
+
+async def cached_chat_completion(
+    client: AsyncOpenAI, msg: cl.Message, tools_key: Optional[str] = None, **params
+) -> Tuple[str, List[dict]]:
+    """
+    stream_chat_completion() behind an in-process LRU of completed responses.
+    
+    A request identical to a recent one (regenerations, repeated questions,
+    tool rounds that returned the same data) replays the stored reply into
+    `msg` instead of calling OpenAI again. `tools_key` is the tools_digest()
+    of params["tools"], if the caller has one precomputed.
+    """
+    if RESPONSE_CACHE_SIZE <= 0:
+        return await stream_chat_completion(client, msg, **params)
+    
+    key = response_cache_key(params, tools_key)
+    cached = _response_cache.get(key)
+    if cached is not None:
+        _response_cache.move_to_end(key)
+        log.info("Response cache hit (%s)", key)
+        content, tool_calls = cached
+        if content:
+            await msg.stream_token(content)
+        return content, copy.deepcopy(tool_calls)
+    
+    content, tool_calls = await stream_chat_completion(client, msg, **params)
+    if content or tool_calls:
+        _response_cache[key] = (content, copy.deepcopy(tool_calls))
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+    return content, tool_calls
+
+
+# ============================================================================
+# Semantic Response Cache
+# ============================================================================
+
+async def embed_text(client: AsyncOpenAI, text: str) -> List[float]:
+    """Embedding of `text` with EMBEDDING_MODEL, scaled to unit length."""
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = response.data[0].embedding
+    norm = sum(x * x for x in vector) ** 0.5 or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticCache:
+    """
+    Final replies of earlier turns, looked up by embedding similarity.
+    
+    Entries are keyed on a context key (the tool set the reply was produced
+    with) plus the question. An exact repeat is found by get() without an
+    embedding round-trip; near-duplicates need lookup(). Vectors are unit
+    length, so cosine similarity is a dot product; a linear scan over
+    SEMANTIC_CACHE_SIZE entries is cheap next to the completion it replaces.
+    Keep one cache per chat and clear it whenever a tool may have changed data.
+    """
+    
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_SIZE):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[List[float], str]]" = OrderedDict()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0 and self.max_entries > 0
+    
+    def get(self, context_key: str, query: str) -> Optional[str]:
+        """Cached reply for exactly this question in the context, if any."""
+        entry = self._entries.get((context_key, query))
+        if entry is None:
+            return None
+        self._entries.move_to_end((context_key, query))
+        log.info("Semantic cache hit (exact question)")
+        return entry[1]
+    
+    def lookup(self, embedding: List[float], context_key: str) -> Optional[str]:
+        """Best cached reply for the context at or above the threshold, if any."""
+        best_score, best_key = self.threshold, None
+        for key, (vector, _) in self._entries.items():
+            if key[0] != context_key:
+                continue
+            score = sum(map(float.__mul__, embedding, vector))
+            if score >= best_score:
+                best_score, best_key = score, key
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        log.info("Semantic cache hit (similarity %.3f)", best_score)
+        return self._entries[best_key][1]
+    
+    def add(self, embedding: List[float], context_key: str, query: str, reply: str):
+        self._entries[(context_key, query)] = (embedding, reply)
+        self._entries.move_to_end((context_key, query))
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+
+
+# ============================================================================
+# Conversation Budget
+# ============================================================================
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken when available, else estimate ~4 chars/token."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def message_tokens(message: dict) -> int:
+    """Approximate prompt tokens used by one chat message."""
+    tokens = 4 + count_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        tokens += count_tokens(tool_call["function"]["arguments"]) + 8
+    return tokens
+
+
+def trim_messages(messages: List[dict], max_tokens: int = MAX_HISTORY_TOKENS) -> List[dict]:
+    """
+    Return the messages to send so that the prompt stays within `max_tokens`.
+    
+    Leading system messages and the latest user message are always kept; the
+    remaining messages are kept newest-first. An assistant message and the
+    tool results answering its tool_calls are kept or dropped together, since
+    OpenAI rejects tool messages without their tool_calls.
+    """
+    head = 0
+    while head < len(messages) and messages[head]["role"] == "system":
+        head += 1
+    
+    # Group into blocks: a user/assistant message plus any tool messages after it
+    blocks: List[List[dict]] = []
+    for msg in messages[head:]:
+        if msg["role"] == "tool" and blocks:
+            blocks[-1].append(msg)
+        else:
+            blocks.append([msg])
+    
+    budget = max_tokens - sum(message_tokens(m) for m in messages[:head])
+    kept: List[List[dict]] = []
+    for block in reversed(blocks):
+        block_tokens = sum(message_tokens(m) for m in block)
+        if kept and block_tokens > budget:
+            break
+        kept.append(block)
+        budget -= block_tokens
+    kept.reverse()
+    
+    if len(kept) == len(blocks):
+        return messages
+    
+    # Keep the question being answered even if older tool rounds are dropped
+    pinned: List[dict] = []
+    if not any(block[0]["role"] == "user" for block in kept):
+        last_user = next((b for b in reversed(blocks) if b[0]["role"] == "user"), None)
+        if last_user:
+            pinned = last_user
+    
+    log.info("Trimmed conversation to %d/%d message blocks", len(kept), len(blocks))
+    return messages[:head] + pinned + [m for block in kept for m in block]
+
+
+def truncate_tool_output(text: str, limit: int = MAX_TOOL_OUTPUT_CHARS) -> str:
+    """Keep the head and tail of an oversized tool output."""
+    if len(text) <= limit:
+        return text
+    half = limit // 2
+    omitted = len(text) - 2 * half
+    return f"{text[:half]}\n\n... [{omitted} characters omitted] ...\n\n{text[-half:]}"
@@ -1,46 +1,136 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+# Shared helpers; importing mcp_common also installs the uvloop policy when USE_UVLOOP=1
+from mcp_common import (
+    OPENAI_HTTPX,
+    SemanticCache,
+    cached_chat_completion,
+    compile_validator,
+    embed_text,
+    format_raw_tool_arguments,
+    get_logger,
+    json_dumps_canonical,
+    openai_tool,
+    parse_tool_arguments,
+    tools_digest,
+    trim_messages,
+)
+
 import chainlit as cl
 from openai import AsyncOpenAI
-import json
 from dotenv import load_dotenv
-import os
 
 load_dotenv()
 
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=OPENAI_HTTPX)
+
+# Diagnostics go through the queued handler in mcp_common; LOG_LEVEL=DEBUG shows per-call detail
+log = get_logger("notes_app")
+
+# System prompt, kept outside the stored history so compaction never drops it
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant with access to note-taking tools."}
+
+# History is append-only until it holds 2 * HISTORY_WINDOW messages, then it is
+# cut back to the last HISTORY_WINDOW. Between cuts every request extends the
+# previous one, so OpenAI's prompt cache keeps matching the prefix.
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "32"))
+
+# Messages sent within this window (milliseconds) are answered as one turn;
+# 0 disables batching so every message gets its own completion
+MESSAGE_BATCH_MS = int(os.getenv("MESSAGE_BATCH_MS", "0"))
+
+# Tools whose output is shown to the user as-is, without a wrap-up completion
+# (comma-separated names, e.g. RAW_OUTPUT_TOOLS=list_notes,read_note)
+RAW_OUTPUT_TOOLS = frozenset(
+    name.strip() for name in os.getenv("RAW_OUTPUT_TOOLS", "").split(",") if name.strip()
+)
+
+# Results of read-only tools are reused for identical calls within this many
+# seconds (0 disables); any other tool call clears the session's cache
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "60"))
+
+# Tools without a readOnlyHint annotation are read-only if named like this
+READ_ONLY_PREFIXES = ("list_", "get_", "read_", "search_")
+
+# Prefix of the result text of a failed tool call
+TOOL_ERROR_PREFIX = "Error calling tool "
+
+@dataclass
+class ChatState:
+    """Per-chat state, stored once under the "state" key and mutated in place"""
+    message_history: List[dict] = field(default_factory=list)
+    # connection name -> tool dicts built in on_mcp_connect
+    mcp_tools: Dict[str, List[dict]] = field(default_factory=dict)
+    # Derived from mcp_tools by cache_openai_tools()
+    tool_owner: Dict[str, str] = field(default_factory=dict)
+    tool_validators: Dict[str, Callable[[dict], Optional[str]]] = field(default_factory=dict)
+    read_only_tools: FrozenSet[str] = frozenset()
+    openai_tools: List[dict] = field(default_factory=list)
+    openai_tools_digest: Optional[str] = None
+    # cache key -> (expiry, result text) for read-only tool calls
+    tool_result_cache: Dict[bytes, Tuple[float, str]] = field(default_factory=dict)
+    # Messages collected while a batching window is open
+    pending_messages: Optional[List[str]] = None
+    # Final replies reused for near-duplicate questions within this chat; off unless
+    # SEMANTIC_CACHE_THRESHOLD is set, and cleared whenever a tool may have changed data
+    semantic_cache: SemanticCache = field(default_factory=SemanticCache)
+
+def chat_state() -> ChatState:
+    """The current chat's state, created on first use"""
+    state = cl.user_session.get("state")
+    if state is None:
+        state = ChatState()
+        cl.user_session.set("state", state)
+    return state
 
 @cl.on_chat_start
 async def start():
     """Initialize the chat session"""
-    cl.user_session.set("message_history", [
-        {"role": "system", "content": "You are a helpful assistant with access to note-taking tools."}
-    ])
+    # Only the history is reset; tools of connections made before this stay registered
+    chat_state().message_history = []
     
     await cl.Message(
         content="Hello! 👋\n\nConnect to MCP servers using the **plug icon (🔌)** in the sidebar to enable tools.\n\nOnce connected, I can help you manage your notes!"
     ).send()
 
+@cl.on_app_shutdown
+async def shutdown():
+    """Close the shared OpenAI connection pool when the server stops"""
+    await OPENAI_HTTPX.aclose()
+
 @cl.on_mcp_connect
 async def on_mcp_connect(connection, session):
     """Handle MCP server connections"""
-    print(f"🔌 MCP Connection event triggered for: {connection.name}")
+    log.debug("MCP connection event for %s", connection.name)
     
     try:
         # List available tools
         result = await session.list_tools()
         
-        # Process tool metadata
+        # Process tool metadata, converting each schema to OpenAI format once per connection.
+        # Sorted by name so the tool list sent to OpenAI has a stable, cacheable order.
         tools = [{
             "name": t.name,
             "description": t.description,
             "input_schema": t.inputSchema,
-        } for t in result.tools]
+            "read_only": is_read_only_tool(t),
+            "openai_tool": openai_tool(t.name, t.description, t.inputSchema),
+            "validator": compile_validator(t.inputSchema),
+        } for t in sorted(result.tools, key=lambda t: t.name)]
         
-        print(f"📋 Found {len(tools)} tools: {[t['name'] for t in tools]}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Found %d tools: %s", len(tools), [t["name"] for t in tools])
         
         # Store tools for later use
-        mcp_tools = cl.user_session.get("mcp_tools", {})
-        mcp_tools[connection.name] = tools
-        cl.user_session.set("mcp_tools", mcp_tools)
+        state = chat_state()
+        state.mcp_tools[connection.name] = tools
+        cache_openai_tools(state)
         
         # Notify user
         tool_names = [t['name'] for t in tools]
@@ -50,9 +140,7 @@ async def on_mcp_connect(connection, session):
         ).send()
         
     except Exception as e:
-        print(f"❌ Error in on_mcp_connect: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("on_mcp_connect failed for %s", connection.name)
         await cl.Message(
             content=f"❌ Failed to connect to {connection.name}: {str(e)}",
             author="System"
@@ -61,25 +149,54 @@ async def on_mcp_connect(connection, session):
 @cl.on_mcp_disconnect
 async def on_mcp_disconnect(name: str):
     """Handle MCP server disconnections"""
-    print(f"🔌 MCP server '{name}' disconnected")
+    log.debug("MCP server %s disconnected", name)
     
     # Remove tools from user session
-    mcp_tools = cl.user_session.get("mcp_tools", {})
-    mcp_tools.pop(name, None)
-    cl.user_session.set("mcp_tools", mcp_tools)
+    state = chat_state()
+    state.mcp_tools.pop(name, None)
+    cache_openai_tools(state)
     
     await cl.Message(
         content=f"❌ Disconnected from **{name}**",
         author="System"
     ).send()
 
+def is_read_only_tool(tool) -> bool:
+    """Whether calling the tool has no side effects, so its result may be reused"""
+    read_only_hint = getattr(getattr(tool, "annotations", None), "readOnlyHint", None)
+    if read_only_hint is not None:
+        return read_only_hint
+    return tool.name.startswith(READ_ONLY_PREFIXES)
+
+def cache_openai_tools(state: ChatState):
+    """Combine the tools of all connections once per connection change"""
+    mcp_tools = state.mcp_tools
+    # Ordered by (connection, tool name), independent of connect/disconnect history
+    all_tools = list(itertools.chain.from_iterable(
+        connection_tools for _, connection_tools in sorted(mcp_tools.items())
+    ))
+    # tool name -> connection name, so a call goes straight to the server that has the tool
+    # (the first connection wins when several servers expose the same name)
+    tool_owner = {}
+    tool_validators = {}
+    for connection_name, connection_tools in mcp_tools.items():
+        for tool in connection_tools:
+            if tool_owner.setdefault(tool["name"], connection_name) == connection_name and tool.get("validator"):
+                tool_validators[tool["name"]] = tool["validator"]
+    state.tool_owner = tool_owner
+    state.tool_validators = tool_validators
+    state.read_only_tools = frozenset(
+        tool["name"] for tool in all_tools if tool.get("read_only")
+    )
+    state.openai_tools = [tool["openai_tool"] for tool in all_tools]
+    # Serialized once here so response-cache keys don't re-encode every schema per call
+    state.openai_tools_digest = tools_digest(state.openai_tools)
+
 def find_mcp_for_tool(tool_name: str) -> str:
     """Find which MCP connection has the given tool"""
-    mcp_tools = cl.user_session.get("mcp_tools", {})
-    
-    for connection_name, tools in mcp_tools.items():
-        if any(t['name'] == tool_name for t in tools):
-            return connection_name
+    connection_name = chat_state().tool_owner.get(tool_name)
+    if connection_name is not None:
+        return connection_name
     
     raise ValueError(f"Tool {tool_name} not found in any MCP connection")
 
@@ -93,7 +210,7 @@ async def call_mcp_tool(tool_name: str, tool_input: dict):
         # Get the MCP session from context
         mcp_session, _ = cl.context.session.mcp_sessions.get(mcp_name)
         
-        print(f"🔧 Calling tool {tool_name} on connection {mcp_name}")
+        log.debug("Calling tool %s on connection %s", tool_name, mcp_name)
         
         # Call the tool
         result = await mcp_session.call_tool(tool_name, tool_input)
@@ -107,118 +224,267 @@ async def call_mcp_tool(tool_name: str, tool_input: dict):
         else:
             result_text = str(result)
         
-        print(f"✅ Tool {tool_name} executed successfully")
+        log.debug("Tool %s executed successfully", tool_name)
         return result_text
         
     except Exception as e:
-        error_msg = f"Error calling tool {tool_name}: {str(e)}"
-        print(f"❌ {error_msg}")
-        import traceback
-        traceback.print_exc()
+        error_msg = f"{TOOL_ERROR_PREFIX}{tool_name}: {str(e)}"
+        log.error("%s", error_msg)
+        # Failures here are per tool call: only pay for the traceback when debugging
+        log.debug("Traceback of the failed %s call", tool_name, exc_info=True)
         return error_msg
 
+def tool_calls_banner(tool_calls: list) -> str:
+    """One chat message announcing every tool call the model requested in a turn"""
+    return "\n".join(
+        f"🔧 Calling: `{tool_call['function']['name']}`\n"
+        f"```json\n{format_raw_tool_arguments(tool_call['function']['arguments'])}\n```"
+        for tool_call in tool_calls
+    )
+
+async def run_tool_call(tool_call: dict, use_cache: bool = True) -> str:
+    """Execute one tool call requested by the model"""
+    function_name = tool_call["function"]["name"]
+    # Parsed once (orjson when available) and handed to the MCP session as-is
+    function_args = parse_tool_arguments(tool_call["function"]["arguments"])
+    
+    state = chat_state()
+    
+    # Bad arguments go back to the model without an MCP round trip (not an error
+    # result, so the loop continues and the model can correct the call)
+    validator = state.tool_validators.get(function_name)
+    if validator is not None:
+        error = validator(function_args)
+        if error is not None:
+            return f"Invalid arguments for tool {function_name}: {error}"
+    
+    tool_cache = state.tool_result_cache
+    
+    if function_name not in state.read_only_tools:
+        try:
+            return await call_mcp_tool(function_name, function_args)
+        finally:
+            # May have changed data that cached reads returned; cleared only once
+            # the call is over, so no read that ran alongside it stays cached
+            tool_cache.clear()
+            state.semantic_cache.clear()
+    
+    if TOOL_CACHE_TTL <= 0 or not use_cache:
+        return await call_mcp_tool(function_name, function_args)
+    
+    now = asyncio.get_running_loop().time()
+    cache_key = hashlib.blake2b(json_dumps_canonical([function_name, function_args]), digest_size=16).digest()
+    cached = tool_cache.get(cache_key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
+    # Call the MCP tool using the documented pattern
+    result_text = await call_mcp_tool(function_name, function_args)
+    if not result_text.startswith(TOOL_ERROR_PREFIX):
+        tool_cache[cache_key] = (now + TOOL_CACHE_TTL, result_text)
+    return result_text
+
+def schedule_tool_calls(state: ChatState, tool_calls: list) -> list:
+    """One future per tool call; repeated read-only calls in the same turn share one execution"""
+    # Reads that run alongside a write may see data from before or after it,
+    # so in such a round they neither use nor fill the result cache
+    use_cache = all(tc["function"]["name"] in state.read_only_tools for tc in tool_calls)
+    in_flight = {}
+    futures = []
+    for tool_call in tool_calls:
+        function = tool_call["function"]
+        if function["name"] not in state.read_only_tools:
+            futures.append(asyncio.ensure_future(run_tool_call(tool_call)))
+            continue
+        key = (function["name"], function["arguments"])
+        future = in_flight.get(key)
+        if future is None:
+            future = in_flight[key] = asyncio.ensure_future(run_tool_call(tool_call, use_cache))
+        futures.append(future)
+    return futures
+
+def collapse_tool_rounds(message_history: list, start: int, content: str):
+    """Store the turn's final reply in place of its tool calls and results (history[start:])"""
+    tool_names = list(dict.fromkeys(
+        tool_call["function"]["name"]
+        for entry in message_history[start:]
+        for tool_call in entry.get("tool_calls") or ()
+    ))
+    if tool_names:
+        # The reply already incorporates the results, so later turns don't resend them
+        content = f"(previously used tools: {', '.join(tool_names)} — results incorporated below)\n{content}"
+    message_history[start:] = [{"role": "assistant", "content": content}]
+
+def compact_history(message_history: list):
+    """Cut the history back to the last HISTORY_WINDOW messages once it reaches twice that"""
+    if len(message_history) <= 2 * HISTORY_WINDOW:
+        return
+    start = len(message_history) - HISTORY_WINDOW
+    # Never start on tool results whose assistant message would be cut off
+    while start < len(message_history) and message_history[start]["role"] == "tool":
+        start += 1
+    if start < len(message_history):
+        del message_history[:start]
+
+def conversation(message_history: list) -> list:
+    """System prompt plus stored history, trimmed to the token budget for one request"""
+    return trim_messages([SYSTEM_MESSAGE] + message_history)
+
 @cl.on_message
 async def main(message: cl.Message):
     """Handle incoming messages"""
-    message_history = cl.user_session.get("message_history", [])
-    message_history.append({"role": "user", "content": message.content})
-    
-    # Get tools from all MCP connections (following documentation)
-    mcp_tools = cl.user_session.get("mcp_tools", {})
-    all_tools = [tool for connection_tools in mcp_tools.values() for tool in connection_tools]
-    
-    # Convert to OpenAI format
-    openai_tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": tool["name"],
-                "description": tool["description"],
-                "parameters": tool["input_schema"]
-            }
-        }
-        for tool in all_tools
-    ]
-    
-    print(f"📊 Available tools: {len(openai_tools)}")
+    state = chat_state()
+    user_content = message.content
+    if MESSAGE_BATCH_MS > 0:
+        pending = state.pending_messages
+        if pending is not None:
+            # A batching window is open: the handler that opened it answers this too
+            pending.append(user_content)
+            return
+        pending = state.pending_messages = [user_content]
+        try:
+            await asyncio.sleep(MESSAGE_BATCH_MS / 1000)
+        except asyncio.CancelledError:
+            # Stopped during the window: keep the messages so the next turn still sees them
+            state.message_history.append({"role": "user", "content": "\n\n".join(pending)})
+            raise
+        finally:
+            state.pending_messages = None
+        user_content = "\n\n".join(pending)
+    
+    message_history = state.message_history
+    
+    # Embedding of the question, kept only while this turn's reply may be cached.
+    # Replies are reused for the same or a similar question asked with the same
+    # tool set; any call that may change data clears the chat's cache.
+    query_embedding = None
+    if state.semantic_cache.enabled:
+        context_key = state.openai_tools_digest or ""
+        cached_reply = state.semantic_cache.get(context_key, user_content)
+        if cached_reply is None:
+            try:
+                query_embedding = await embed_text(client, user_content)
+            except Exception as e:
+                log.warning("Embedding failed, skipping semantic cache: %s", e)
+            else:
+                cached_reply = state.semantic_cache.lookup(query_embedding, context_key)
+        if cached_reply is not None:
+            message_history.append({"role": "user", "content": user_content})
+            message_history.append({"role": "assistant", "content": cached_reply})
+            compact_history(message_history)
+            await cl.Message(content=cached_reply).send()
+            return
+    
+    message_history.append({"role": "user", "content": user_content})
+    compact_history(message_history)
+    # Tool rounds of this turn start here; they are collapsed once the reply is final
+    turn_start = len(message_history)
+    
+    # Tools from all MCP connections, already in OpenAI format (see cache_openai_tools)
+    openai_tools = state.openai_tools
+    tools_key = state.openai_tools_digest
+    
+    log.debug("Available tools: %d", len(openai_tools))
     
     try:
         # Call OpenAI with or without tools
-        params = {
-            "model": "gpt-4o",
-            "messages": message_history
-        }
+        params = {"model": "gpt-4o"}
         
         if openai_tools:
             params["tools"] = openai_tools
             params["tool_choice"] = "auto"
         
-        response = await client.chat.completions.create(**params)
-        response_message = response.choices[0].message
+        # Stream the reply so text shows up as soon as the first tokens arrive
+        reply = cl.Message(content="")
+        content, tool_calls = await cached_chat_completion(
+            client,
+            reply,
+            tools_key=tools_key,
+            messages=conversation(message_history),
+            **params
+        )
+        
+        # Tool-call banners still being sent; they overlap the tool calls and the next completion
+        status_tasks = []
         
         # Handle tool calls in a loop
-        while response_message.tool_calls:
+        while tool_calls:
+            # Close out any text the model streamed alongside its tool calls
+            if content:
+                await reply.send()
+            
+            # A reply that depends on changing data must not be replayed
+            if any(tc["function"]["name"] not in state.read_only_tools for tc in tool_calls):
+                query_embedding = None
+            
             # Add assistant message with tool calls to history
             message_history.append({
                 "role": "assistant",
-                "content": response_message.content or "",
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    }
-                    for tc in response_message.tool_calls
-                ]
+                "content": content or None,
+                "tool_calls": tool_calls
             })
             
-            # Execute each tool call
-            for tool_call in response_message.tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-                
-                await cl.Message(
-                    content=f"🔧 Calling: `{function_name}`\n```json\n{json.dumps(function_args, indent=2)}\n```",
-                    author="System"
-                ).send()
-                
-                # Call the MCP tool using the documented pattern
-                result_text = await call_mcp_tool(function_name, function_args)
+            # One banner for the round, sent in the background so the MCP calls don't wait on the frontend
+            status_tasks.append(asyncio.create_task(
+                cl.Message(content=tool_calls_banner(tool_calls), author="System").send()
+            ))
+            
+            # Tool calls in one assistant message are independent: run them concurrently
+            results = await asyncio.gather(
+                *schedule_tool_calls(state, tool_calls),
+                return_exceptions=True
+            )
+            
+            outputs = []
+            for tool_call, result_text in zip(tool_calls, results):
+                function_name = tool_call["function"]["name"]
+                if isinstance(result_text, Exception):
+                    result_text = f"{TOOL_ERROR_PREFIX}{function_name}: {str(result_text)}"
+                outputs.append(result_text)
                 
-                # Add tool result to history
+                # Add tool result to history, in the order the model requested the calls
                 message_history.append({
                     "role": "tool",
-                    "tool_call_id": tool_call.id,
+                    "tool_call_id": tool_call["id"],
                     "name": function_name,
                     "content": result_text
                 })
             
-            # Get next response from OpenAI
-            response = await client.chat.completions.create(
-                model="gpt-4o",
-                messages=message_history,
-                tools=openai_tools if openai_tools else None,
-                tool_choice="auto" if openai_tools else None
+            # Every call raised: surface the errors instead of another completion. An empty
+            # result (e.g. no notes yet) is a successful answer for the model to use.
+            if all(output.startswith(TOOL_ERROR_PREFIX) for output in outputs):
+                content = "❌ " + "\n".join(outputs)
+                query_embedding = None
+                reply = cl.Message(content=content)
+                break
+            
+            # Raw-output tools already produced the answer: skip the follow-up completion
+            if RAW_OUTPUT_TOOLS and all(tc["function"]["name"] in RAW_OUTPUT_TOOLS for tc in tool_calls):
+                content = "\n\n".join(outputs)
+                reply = cl.Message(content=content)
+                break
+            
+            # Stream the next response from OpenAI
+            reply = cl.Message(content="")
+            content, tool_calls = await cached_chat_completion(
+                client,
+                reply,
+                tools_key=tools_key,
+                messages=conversation(message_history),
+                **params
             )
-            response_message = response.choices[0].message
         
-        # Final response without tool calls
-        if response_message.content:
-            message_history.append({
-                "role": "assistant",
-                "content": response_message.content
-            })
-            await cl.Message(content=response_message.content).send()
+        # Every banner is on screen before the final reply
+        await asyncio.gather(*status_tasks, return_exceptions=True)
         
-        # Update session history
-        cl.user_session.set("message_history", message_history)
+        # Final response without tool calls
+        if content:
+            collapse_tool_rounds(message_history, turn_start, content)
+            await reply.send()  # Ends the token stream and persists the message
+            if query_embedding is not None:
+                state.semantic_cache.add(query_embedding, context_key, user_content, content)
             
     except Exception as e:
         error_msg = f"Error: {type(e).__name__}: {str(e)}"
-        print(f"❌ {error_msg}")
-        import traceback
-        traceback.print_exc()
+        log.exception("%s", error_msg)
         await cl.Message(content=f"❌ {error_msg}").send()
\ No newline at end of file
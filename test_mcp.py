@@ -1,37 +1,190 @@
 # test_mcp.py - Run this first to test the connection
+import argparse
 import asyncio
+import json
+import os
+import socket
+import sys
+import traceback
+from typing import Optional
 import httpx
 
-async def test_sse_connection():
+# Run on uvloop's libuv-based event loop when it is installed
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+MCP_URL = "http://10.75.11.84:8000/mcp"
+
+# Separate budgets per phase: an unreachable server fails fast on connect,
+# while the read timeout (the longest wait between two events) can be raised
+# or disabled with SSE_READ_TIMEOUT=0 to watch a quiet stream
+CONNECT_TIMEOUT = float(os.getenv("SSE_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("SSE_READ_TIMEOUT", "10")) or None
+
+# orjson parses the bytes payloads directly and several times faster; optional
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads  # also accepts bytes
+
+# SSE field prefixes; bytes.startswith() checks the whole tuple in one C call
+FIELDS = (b"data:", b"event:", b"id:", b"retry:")
+
+# HTTP/2 is only negotiated when the optional 'h2' package is installed
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+# One client for the whole run, so repeated probes reuse pooled connections
+# (over HTTP/2, concurrent probes of one host share a single connection).
+# Nagle is off so small SSE frames sent by the client aren't held back; with
+# a custom transport, pool and HTTP/2 settings must be given to the transport.
+HTTPX = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_connections=128, max_keepalive_connections=32, keepalive_expiry=30.0),
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+    ),
+    timeout=httpx.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=5.0, pool=2.0),
+)
+
+async def iter_events(response: httpx.Response):
+    """Yield each SSE event as one bytes object (its lines, without the closing blank line)"""
+    buffer = bytearray()
+    # No chunk_size: httpx would hold data back until that many bytes arrived
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        if b"\r" in buffer:
+            buffer = buffer.replace(b"\r\n", b"\n")
+        # Only complete events are copied out; the partial tail stays in the buffer
+        start = 0
+        while (end := buffer.find(b"\n\n", start)) >= 0:
+            yield bytes(buffer[start:end])
+            start = end + 2
+        del buffer[:start]
+    if buffer.strip():
+        yield bytes(buffer)
+
+async def read_events(response: httpx.Response, queue: asyncio.Queue):
+    """Producer: queue each event, then None (or the error that ended the stream)"""
+    try:
+        async for event in iter_events(response):
+            await queue.put(event)
+    except Exception as e:
+        await queue.put(e)
+        return
+    await queue.put(None)
+
+async def test_sse_connection(
+    url: str = MCP_URL,
+    client: httpx.AsyncClient = HTTPX,
+    max_lines: int = 11,
+    max_events: Optional[int] = None,
+):
     """Test SSE connection to MCP server"""
-    url = "http://10.75.11.84:8000/mcp"
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            async with client.stream(
-                "GET",
-                url,
-                headers={
-                    "Accept": "text/event-stream",
-                    "Cache-Control": "no-cache",
-                },
-                timeout=10.0
-            ) as response:
-                print(f"Status: {response.status_code}")
-                print(f"Headers: {response.headers}")
-                
-                # Read first few events
-                count = 0
-                async for line in response.aiter_lines():
-                    print(f"Line: {line}")
-                    count += 1
-                    if count > 10:
+    # Output is written as the stream arrives, one write per event, so an
+    # event's lines stay together when several probes run concurrently
+    out = bytearray()
+    try:
+        async with client.stream(
+            "GET",
+            url,
+            headers={
+                "Accept": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "Accept-Encoding": "identity",  # small SSE frames: skip the decompression stage
+            },
+        ) as response:
+            out += f"Status: {response.status_code}\nHeaders: {response.headers}\n".encode()
+            if response.http_version != "HTTP/2":
+                out += (
+                    f"Warning: stream is {response.http_version}; small events can be delayed "
+                    "by Nagle's algorithm unless the server sets TCP_NODELAY\n"
+                ).encode()
+            write_stdout(out)
+            
+            # Read the first max_lines lines (blank event separators included),
+            # or max_events events when given. The reader keeps up to 64 events
+            # queued ahead of this consumer, so socket reads overlap the
+            # formatting; lines stay raw bytes and are never decoded.
+            queue = asyncio.Queue(maxsize=64)
+            producer = asyncio.create_task(read_events(response, queue))
+            field_counts = {}
+            payloads_ok = payloads_bad = 0
+            lines_left = max_lines if max_events is None else None
+            events_left = max_events
+            try:
+                while lines_left != 0 and events_left != 0:
+                    event = await queue.get()
+                    if event is None:
                         break
-                        
-        except Exception as e:
-            print(f"Error: {e}")
-            import traceback
-            traceback.print_exc()
+                    if isinstance(event, Exception):
+                        raise event
+                    if events_left is not None:
+                        events_left -= 1
+                    lines = event.split(b"\n")
+                    lines.append(b"")  # the blank line that ended the event
+                    complete = True
+                    if lines_left is not None:
+                        complete = len(lines) <= lines_left
+                        del lines[lines_left:]
+                        lines_left -= len(lines)
+                    data_lines = []
+                    for line in lines:
+                        out += b"Line: " + line + b"\n"
+                        if line.startswith(FIELDS):
+                            field = line[:line.index(b":")]
+                            field_counts[field] = field_counts.get(field, 0) + 1
+                            if field == b"data":
+                                data_lines.append(line[5:].removeprefix(b" "))
+                    write_stdout(out)
+                    
+                    # MCP messages are JSON: check each fully shown event's payload parses
+                    if data_lines and complete:
+                        try:
+                            json_loads(b"\n".join(data_lines))
+                            payloads_ok += 1
+                        except ValueError:
+                            payloads_bad += 1
+            finally:
+                producer.cancel()
+                await asyncio.gather(producer, return_exceptions=True)
+            
+            if field_counts:
+                out += b"Fields: " + b", ".join(b"%s=%d" % item for item in field_counts.items()) + b"\n"
+            if payloads_ok or payloads_bad:
+                out += b"JSON payloads: %d valid, %d invalid\n" % (payloads_ok, payloads_bad)
+            write_stdout(out)
+                    
+    except Exception as e:
+        write_stdout(out)
+        print(f"Error: {e}")
+        traceback.print_exc()
+
+def write_stdout(data: bytearray):
+    """Write and flush the pending output in one call, then empty the buffer"""
+    sys.stdout.flush()  # anything already print()ed goes first
+    sys.stdout.buffer.write(data)
+    sys.stdout.flush()
+    data.clear()
+
+async def main(urls, max_lines: int = 11, max_events: Optional[int] = None):
+    """Probe all URLs concurrently on one event loop and one client"""
+    try:
+        await asyncio.gather(*(test_sse_connection(url, HTTPX, max_lines, max_events) for url in urls))
+    finally:
+        await HTTPX.aclose()
 
 if __name__ == "__main__":
-    asyncio.run(test_sse_connection())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Watch the SSE stream of one or more MCP endpoints")
+    parser.add_argument("urls", nargs="*", default=[MCP_URL], help=f"endpoints to probe (default: {MCP_URL})")
+    parser.add_argument("--max-lines", type=int, default=11, help="stop after this many lines (default: 11)")
+    parser.add_argument("--max-events", type=int, help="stop after this many events instead of counting lines")
+    args = parser.parse_args()
+    asyncio.run(main(args.urls, args.max_lines, args.max_events))